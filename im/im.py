@@ -1,26 +1,40 @@
 import argparse
-import multiprocessing as mp
+import json
+import math
 import os
 import shutil
 import sys
+import time
 import traceback
 from datetime import datetime
 from functools import partial
 
-from PIL import Image, ImageOps
+from PIL import Image, ImageColor, ImageDraw, ImageOps
 
 from im.display import CursesDisplay
+from im.index import open_index, query_files, refreshed_index, update_index
+from im.pool import LIMITS, REPORT, Progress, imap_pool, run_pool
+from im.stats import Stats
 from im.utils import *
 
 
 def im_cmd():
     parser = argparse.ArgumentParser(description='Image manipulation tool.')
+    parser.add_argument('--timeout', dest='pool_timeout', help='Per file time limit (s) of parallel commands.', type=float, default=LIMITS['timeout'])
+    parser.add_argument('--memory', dest='pool_memory', help='Per worker memory limit (MB) of parallel commands.', type=int, default=LIMITS['memory'])
+    parser.add_argument('--max-tasks', dest='pool_max_tasks', help='Files processed by worker before it is restarted.', type=int, default=LIMITS['max_tasks'])
+    parser.add_argument('--io-depth', dest='pool_io_depth', help='''Files read ahead / written behind by I/O threads of
+                        parallel commands, 0 to read and write in workers.''', type=int, default=LIMITS['io_depth'])
+    parser.add_argument('--json', dest='pool_json', help='''Print result record of every file processed by parallel
+                        command as JSON line instead of progress line (stats prints its own JSON document, index
+                        summary goes to stderr).''', action='store_true')
+    parser.add_argument('--retries', dest='pool_retries', help='Retries of files which timed out or crashed worker.', type=int, default=LIMITS['retries'])
     subparsers = parser.add_subparsers()
 
     parser_gray = subparsers.add_parser('gray', description='Convert image to grayscale.',
                                         help='Convert image to grayscale.',
                                         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser_gray.set_defaults(func=gray, help="Convert image to grayscale")
+    parser_gray.set_defaults(func=gray)
     parser_gray.add_argument('files', metavar='FILE', nargs='+', type=str)
     parser_gray.add_argument('--overwrite', '-w', help='Overwrite input images.', action='store_true')
 
@@ -31,6 +45,12 @@ def im_cmd():
     parser_stack.add_argument('files', metavar='FILE', nargs='+', type=str)
     parser_stack.add_argument('--vertical', '-v', help='Join images vertically.', action='store_true')
     parser_stack.add_argument('--output', '-o', help='Path to output image.', default=None)
+    parser_stack.add_argument('--montage', '-m', help='Join images into grid (contact sheet).', action='store_true')
+    parser_stack.add_argument('--cols', '-c', help='Montage columns, 0 for square grid.', type=int, default=0)
+    parser_stack.add_argument('--tile-size', '-t', help='Montage cell width.', type=int, default=256)
+    parser_stack.add_argument('--padding', '-p', help='Montage space between cells.', type=int, default=0)
+    parser_stack.add_argument('--labels', '-l', help='Put file names under montage cells.', action='store_true')
+    parser_stack.add_argument('--background', '-b', help='Montage background color.', type=str, default='white')
 
     parser_resize = subparsers.add_parser('resize', description='Resize image to inserted size (higher dimension).',
                                           help='Resize image to inserted size (higher dimension).',
@@ -84,6 +104,9 @@ def im_cmd():
     parser_filter.add_argument('files', metavar='FILE', nargs='+', type=str)
     parser_filter.add_argument('--criterion', '-c', help='''Images filtering criterion. Python expression returning
                                bool value''', default='w * h > 100')
+    parser_filter.add_argument('--index', '-i', help='''Answer from metadata index (see "im index"), criterion can
+                               use w, h, format, mode, orientation and datetime (orientation and datetime are None for
+                               images without exif, e.g. "orientation and orientation > 1").''', default=None)
 
     parser_convert = subparsers.add_parser('convert', description='Convert image to another format.',
                                            help='Convert image to another format.',
@@ -92,6 +115,10 @@ def im_cmd():
     parser_convert.add_argument('files', metavar='FILE', nargs='+', type=str)
     parser_convert.add_argument('--extension', '-e', help='Required new image extension', default='.png')
     parser_convert.add_argument('--overwrite', '-w', help='Overwrite input images.', action='store_true')
+    parser_convert.add_argument('--preset', '-p', help='''Encoder settings, speed/size trade-off (see ENCODER_PRESETS),
+                                keeps encoder defaults where fast / small is not defined for target format, lossless is
+                                rejected for formats which cannot store it.''',
+                                choices=PRESETS, default='default')
 
     parser_gauss = subparsers.add_parser('gauss', description='Generate image with Gauss noise.',
                                          help='Generate image with Gauss noise.',
@@ -115,6 +142,7 @@ def im_cmd():
     parser_findext.set_defaults(func=find_ext)
     parser_findext.add_argument('files', metavar='FILE', nargs='+', type=str)
     parser_findext.add_argument('--append', '-a', help='Append extension to file.', action='store_true')
+    parser_findext.add_argument('--index', '-i', help='Answer from metadata index (see "im index").', default=None)
 
     parser_find_no_img = subparsers.add_parser('find_noim', description='Find non-image files and (optionally) remove it.',
                                                help='Find non-image files and (optionally) remove it.',
@@ -155,35 +183,120 @@ def im_cmd():
     parser_rename.add_argument('--pattern', '-p', help='Rename pattern', type=str,
                                default='%Y_%m_%dT%H_%M_%S-ORIG_NAME.JPG')
     parser_rename.add_argument('--overwrite', '-w', help='Overwrite input images.', action='store_true')
+    parser_rename.add_argument('--index', '-i', help='Answer from metadata index (see "im index").', default=None)
 
     info_help = "Show info about input image (size, exif, ...)"
     parser_info = subparsers.add_parser('info', description=info_help, help=info_help,
                                         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser_info.set_defaults(func=info)
     parser_info.add_argument('files', metavar='FILE', nargs='+', type=str)
+    parser_info.add_argument('--index', '-i', help='Answer from metadata index (see "im index").', default=None)
+
+    stats_help = "Collection statistics (channel mean/std, histograms, sizes, formats) as JSON, regardless of --json"
+    parser_stats = subparsers.add_parser('stats', description=stats_help, help=stats_help,
+                                         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser_stats.set_defaults(func=stats)
+    parser_stats.add_argument('files', metavar='FILE', nargs='+', type=str)
+    parser_stats.add_argument('--max-size', '-s', help='Decode images reduced to this higher dimension, 0 for full size.',
+                              type=int, default=0)
+    parser_stats.add_argument('--output', '-o', help='Path to output JSON file, stdout by default.', default=None)
+
+    index_help = "Build or refresh metadata index (size, format, mode, exif date, orientation) of images"
+    parser_index = subparsers.add_parser('index', description=index_help, help=index_help,
+                                         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser_index.set_defaults(func=build_index)
+    parser_index.add_argument('files', metavar='FILE', nargs='+', type=str)
+    parser_index.add_argument('--index', '-i', help='Path to SQLite index file.', default='im.sqlite')
 
     args = vars(parser.parse_args())
+    for key in LIMITS:
+        LIMITS[key] = args.pop('pool_' + key)  # Prefixed, subcommands may use same option names (show -t).
+    REPORT['json'] = args.pop('pool_json')
     if 'func' in args:
         func = args.pop('func')
-        func(**args)
+        try:
+            failures = func(**args)
+        except UsageError as e:
+            parser.error(str(e))
+        if failures:
+            sys.exit(1)
     else:
         parser.print_help()
 
 
-def gray(files: list, overwrite: bool):
-    for i, src_file in enumerate(files):
-        image, exf = imread(src_file)
-        if overwrite:
-            out_file = src_file
-        else:
-            path_base, ext = os.path.splitext(src_file)
-            out_file = '%s_gray%s' % (path_base, ext)
-        print(src_file, '-->', out_file, 'graying ...')
-        image_gray = ImageOps.grayscale(image)
-        imwrite(image_gray, out_file, exf)
+def _record(src: str, out_file: str, **fields) -> dict:
+    """Result record of file processed in pool (see Progress), call before out_file is written. Size of prefetched
+    input is added by the pool."""
+    record = {'output': out_file, **fields}
+    if not is_deferred():
+        record['bytes_in'] = os.stat(src).st_size
+    return record
 
 
-def stack(files: list, output: str, vertical: bool):
+def _gray(src: str, overwrite: bool) -> dict:
+    if overwrite:
+        out_file = src
+    else:
+        path_base, ext = os.path.splitext(src)
+        out_file = '%s_gray%s' % (path_base, ext)
+    record = _record(src, out_file)
+    image, exf = imread_gray(src)
+    image, frames = map_frames(image, ImageOps.grayscale)  # Cheap copy for already L mode (JPEG draft).
+    record['bytes_out'] = imwrite(image, out_file, exf, frames)
+    return record
+
+
+def gray(files: list, overwrite: bool):
+    return run_pool(partial(_gray, overwrite=overwrite), files, prefetch=True)
+
+
+def _montage_cell(task: tuple, cell_size: tuple, label_height: int, background: str) -> dict:
+    _, src = task
+    record = _record(src, None)
+    image, _ = imread(src)
+    image.thumbnail(cell_size, Image.LANCZOS)  # Uses JPEG draft, decodes at reduced scale close to cell size.
+    cell_w, cell_h = cell_size
+    cell = Image.new('RGB', (cell_w, cell_h + label_height), background)
+    cell.paste(image.convert('RGB'), ((cell_w - image.width) // 2, (cell_h - image.height) // 2))
+    if label_height:
+        fill = tuple(255 - c for c in ImageColor.getrgb(background)[:3])
+        ImageDraw.Draw(cell).text((2, cell_h), os.path.basename(src), fill=fill)
+    record['cell'] = cell
+    return record
+
+
+def _montage(files: list, output: str, cols: int, tile_size: int, padding: int, labels: bool, background: str):
+    sizes = []
+    for src in files:  # Header only, layout cell aspect ratio is the average one.
+        try:
+            with Image.open(src) as image:
+                sizes.append(image.size)
+        except Exception:
+            pass
+    aspect = sum(h / w for w, h in sizes) / len(sizes) if sizes else 1.0
+    cell_size = (tile_size, max(1, round(tile_size * aspect)))
+    label_height = 12 if labels else 0
+    cols = cols or math.ceil(math.sqrt(len(files)))
+    rows = math.ceil(len(files) / cols)
+    step_x = cell_size[0] + padding
+    step_y = cell_size[1] + label_height + padding
+    canvas = Image.new('RGB', (cols * step_x + padding, rows * step_y + padding), background)
+    print('%d images --> %s %dx%d montage ...' % (len(files), output, cols, rows), file=sys.stderr)
+    cell_func = partial(_montage_cell, cell_size=cell_size, label_height=label_height, background=background)
+    progress = Progress(len(files))
+    for (i, src), result, error in imap_pool(cell_func, list(enumerate(files))):
+        if error is None:
+            cell = result.pop('cell')
+            canvas.paste(cell, (padding + (i % cols) * step_x, padding + (i // cols) * step_y))
+        progress.add(src, result, error)
+    imwrite(canvas, output)
+    return progress.close()
+
+
+def stack(files: list, output: str, vertical: bool, montage: bool = False, cols: int = 0, tile_size: int = 256,
+          padding: int = 0, labels: bool = False, background: str = 'white'):
+    if montage:
+        return _montage(files, output or 'montage.jpg', cols, tile_size, padding, labels, background)
     if not output:
         output = '-'.join(files)
     ims = [np.asarray(imread(im)[0], dtype=np.uint8) for im in files]
@@ -221,25 +334,27 @@ def resize(files: list, overwrite: bool, size: int, width: int, height: int):
         print(m_input, '-->', out_file, 'resizing ...')
         image, exf = imread(m_input)
         if width > 0:
-            image2 = image.resize((width, height))
+            new_size, resample = (width, height), None
         else:
             resample = Image.BICUBIC # default
             f = size / max(image.size)
             if f < 1.0:
                 resample = Image.LANCZOS
             w, h = image.size
-            image2 = image.resize((int(f * w), int(f * h)), resample)
-        imwrite(image2, out_file, exf)
+            new_size = (int(f * w), int(f * h))
+        image2, frames = map_frames(image, partial(Image.Image.resize, size=new_size, resample=resample))
+        imwrite(image2, out_file, exf, frames)
 
 
-def _remove_exif(m_input: str):
+def _remove_exif(m_input: str) -> dict:
+    record = _record(m_input, m_input)
     image, exf = imread(m_input)
-    print(m_input, ' removing exif.')
     _, image, exf = try_rot_exif(image, exf)
-    imwrite(image, m_input)
+    record['bytes_out'] = imwrite(image, m_input)
+    return record
 
 
-def _add_image_description(src: str, comment: str, overwrite: bool):
+def _add_image_description(src: str, comment: str, overwrite: bool) -> dict:
     image, exf = imread(src)
     exf["0th"][piexif.ImageIFD.ImageDescription] = comment.encode()
     if overwrite:
@@ -247,8 +362,9 @@ def _add_image_description(src: str, comment: str, overwrite: bool):
     else:
         path_base, ext = os.path.splitext(src)
         out_file = '%s_commented%s' % (path_base, ext)
-    print(src, '-->', out_file, 'adding comment ...')
-    imwrite(image, out_file, exf)
+    record = _record(src, out_file)
+    record['bytes_out'] = imwrite(image, out_file, exf)
+    return record
 
 
 def _exif_show(exf: dict):
@@ -267,12 +383,9 @@ def _exif_show(exf: dict):
 
 def exif(files: list, remove: bool, comment: str, overwrite: bool):
     if remove:
-        pool = mp.Pool(mp.cpu_count())
-        pool.map(_remove_exif, files)
-        pool.close()
+        return run_pool(_remove_exif, files, prefetch=True)
     elif comment is not None:
-        with mp.Pool(mp.cpu_count()) as pool:
-            pool.map(partial(_add_image_description, comment=comment, overwrite=overwrite), files)
+        return run_pool(partial(_add_image_description, comment=comment, overwrite=overwrite), files, prefetch=True)
     else:
         for i, m_input in enumerate(files):
             image, exf = imread(m_input)
@@ -288,11 +401,8 @@ def flip(files: list, vertical: bool, overwrite: bool):
             out_file = '%s_flipped%s' % (path_base, ext)
         print(m_input, '-->', out_file, 'flipping ...')
         image, exf = imread(m_input)
-        if vertical:
-            image = ImageOps.flip(image)
-        else:
-            image = ImageOps.mirror(image)
-        imwrite(image, out_file, exf)
+        image, frames = map_frames(image, ImageOps.flip if vertical else ImageOps.mirror)
+        imwrite(image, out_file, exf, frames)
 
 
 def rotate(files: list, overwrite: bool):
@@ -321,13 +431,16 @@ def crop(files: list, x: int, y: int, width: int, height: int, overwrite: bool):
             out_file = '%s_cropped%s' % (path_base, ext)
         print(m_input, '-->', out_file, 'croping ...')
         image, exf = imread(m_input)
-        image = np.asarray(image, dtype=np.uint8)
-        print(y, height, x, width)
-        image2 = image[y:y+height, x:x+width, :]
-        imwrite(Image.fromarray(image2), out_file, exf)
+        w, h = image.size
+        box = (x, y, min(x + width, w), min(y + height, h))  # Clip window to image as array slicing did.
+        image2, frames = map_frames(image, partial(Image.Image.crop, box=box))
+        imwrite(image2, out_file, exf, frames)
 
 
-def filter(files: list, criterion: str):
+def filter(files: list, criterion: str, index: str = None):
+    if index:
+        _filter_index(files, criterion, index)
+        return
     for m_input in files:
         image, exf = imread(m_input)
         image = np.asarray(image, dtype=np.uint8)
@@ -338,32 +451,42 @@ def filter(files: list, criterion: str):
             print(m_input)
 
 
-def _convert(m_input: str, extension: str, overwrite: bool):
-    try:
-        image, exf = imread(m_input)
-        image = np.asarray(image, dtype=np.uint8)
-        path_base, ext = os.path.splitext(m_input)
-        new_file_path = path_base + extension
-        print('%s --> %s' % (m_input, new_file_path))
-        imwrite(Image.fromarray(image), new_file_path)
-        if overwrite:
-            os.remove(m_input)
-    except Exception as e:
-        print('Error conversion %s:' % m_input, e)
-
-
-def convert(files: list, extension: str, overwrite: bool):
-    with mp.Pool(mp.cpu_count()) as pool:
-        pool.map(partial(_convert, extension=extension, overwrite=overwrite), files)
-
-
-def _gauss(m_input: str, std_dev: int, overwrite: bool):
+def _convert(m_input: str, extension: str, overwrite: bool, preset: str = 'default') -> dict:
+    image, exf = imread(m_input)
+    path_base, ext = os.path.splitext(m_input)
+    new_file_path = path_base + extension
+    record = _record(m_input, new_file_path)
+    fmt = Image.registered_extensions().get(extension.lower())
+    if is_animated(image) and fmt in Image.SAVE_ALL:  # Other formats get the first frame only.
+        # GIF decodes first frame as P and the rest as RGB(A), unify modes so any target format accepts them.
+        image, frames = map_frames(image, lambda frame: frame.convert('RGBA' if frame.has_transparency_data else 'RGB'))
+    else:
+        frames = None
+        image.load()  # Decode here, so only encoding is timed below.
+        image = save_mode(image, fmt)  # E.g. no alpha nor palette in JPEG, no CMYK in PNG.
+    start = time.perf_counter()
+    record['bytes_out'] = imwrite(image, new_file_path, exf, frames, **encoder_params(fmt, preset))
+    record['encode_time'] = round(time.perf_counter() - start, 6)
+    if overwrite and new_file_path != m_input:
+        remove_file(m_input)  # After the new file is written.
+    return record
+
+
+def convert(files: list, extension: str, overwrite: bool, preset: str = 'default'):
+    fmt = Image.registered_extensions().get(extension.lower())
+    if fmt is None:
+        raise UsageError('unknown file extension: %s' % extension)
+    encoder_params(fmt, preset)  # Reject before any file is read.
+    return run_pool(partial(_convert, extension=extension, overwrite=overwrite, preset=preset), files, prefetch=True)
+
+
+def _gauss(m_input: str, std_dev: int, overwrite: bool) -> dict:
     if overwrite:
         out_file = m_input
     else:
         path_base, ext = os.path.splitext(m_input)
         out_file = '%s_gaussed%s' % (path_base, ext)
-    print('%s --> %s' % (m_input, out_file))
+    record = _record(m_input, out_file)
     image, exf = imread(m_input)
     image = np.asarray(image, dtype=np.uint8)
     noise = np.random.normal(0, std_dev, image.shape)
@@ -371,12 +494,12 @@ def _gauss(m_input: str, std_dev: int, overwrite: bool):
     image -= image.min()
     image /= (image.max() / 255.0)
     image = image.astype(np.uint8)
-    imwrite(Image.fromarray(image), out_file)
+    record['bytes_out'] = imwrite(Image.fromarray(image), out_file)
+    return record
 
 
 def gauss(files: list, std_dev: float, overwrite: bool):
-    with mp.Pool(mp.cpu_count()) as pool:
-        pool.map(partial(_gauss, std_dev=std_dev, overwrite=overwrite), files)
+    return run_pool(partial(_gauss, std_dev=std_dev, overwrite=overwrite), files, prefetch=True)
 
 
 def show(files: list, slideshow: bool, timeout: int):
@@ -384,40 +507,62 @@ def show(files: list, slideshow: bool, timeout: int):
     d.run(files)
 
 
-def _find_ext(src: str, append: bool):
-    try:
-        img, _ = imread(src)
-        fmt = img.format
-        if append:
-            ext = 'jpg' if fmt == 'JPEG' else fmt.lower()  # Use jpg extension, not jpeg.
-            dst = f'{src}.{ext}'
-            shutil.move(src, dst)
-            print('%s --> %s' % (src, dst))
-        else:
-            print(f'{src} format: {fmt}')
-    except Exception as e:
-        print('Image %s: %s' % (src, e))
+def _filter_index(files: list, criterion: str, index: str):
 
+    def satisfied(file, w, h, format, mode, orientation, datetime):
+        try:
+            return bool(eval(criterion))
+        except Exception as e:  # SQLite would hide it behind "user-defined function raised exception".
+            print('%s: %s: %s' % (file, type(e).__name__, e), file=sys.stderr)
+            return False
 
-def find_ext(files: list, append=bool):
-    with mp.Pool(mp.cpu_count()) as pool:
-        pool.map(partial(_find_ext, append=append), files)
+    with refreshed_index(index, files) as conn:
+        conn.create_function('satisfied', 7, satisfied)
+        where = 'error IS NULL AND satisfied(args.file, width, height, format, mode, orientation, datetime)'
+        for row in query_files(conn, files, where):
+            print(row['file'])
 
 
-def _find_noim(src: str, delete: bool):
+def _find_ext(src: str, append: bool, fmt: str = None) -> dict:
+    if fmt is None:
+        img, _ = imread(src)
+        fmt = img.format
+    if append:
+        ext = 'jpg' if fmt == 'JPEG' else fmt.lower()  # Use jpg extension, not jpeg.
+        dst = f'{src}.{ext}'
+        shutil.move(src, dst)
+        return {'output': dst}
+    return {'message': f'{src} format: {fmt}'}
+
+
+def find_ext(files: list, append=bool, index: str = None):
+    if index:
+        progress = Progress(len(files))
+        with refreshed_index(index, files) as conn:
+            for row in query_files(conn, files):
+                if row['error']:
+                    progress.add(row['file'], None, row['error'])
+                    continue
+                try:
+                    progress.add(row['file'], _find_ext(row['file'], append, row['format']))
+                except Exception as e:
+                    progress.add(row['file'], None, '%s: %s' % (type(e).__name__, e))
+        return progress.close()
+    return run_pool(partial(_find_ext, append=append), files)
+
+
+def _find_noim(src: str, delete: bool) -> dict:
     try:
         img, _ = imread(src)
     except Exception as e:
         if delete:
             os.remove(src)
-            print('Removing %s' % src)
-        else:
-            print('Image %s: %s' % (src, e))
+            return {'message': 'Removing %s' % src}
+        return {'message': 'Image %s: %s' % (src, e)}
 
 
 def find_noim(files: list, delete=bool):
-    with mp.Pool(mp.cpu_count()) as pool:
-        pool.map(partial(_find_noim, delete=delete), files)
+    return run_pool(partial(_find_noim, delete=delete), files)
 
 
 def ev(files: list, code: str):
@@ -426,76 +571,73 @@ def ev(files: list, code: str):
         eval(code)
 
 
-def _border(m_input: str, width: int, color: str, overwrite: bool):
+def _border(m_input: str, width: int, color: str, overwrite: bool) -> dict:
     if overwrite:
         out_file = m_input
     else:
         path_base, ext = os.path.splitext(m_input)
         out_file = '%s_border%s' % (path_base, ext)
-    print('%s --> %s' % (m_input, out_file))
+    record = _record(m_input, out_file)
     image, exf = imread(m_input)
-    image = ImageOps.expand(image, border=width, fill=color)
-    imwrite(image, out_file, exf)
+    image, frames = map_frames(image, lambda frame: ImageOps.expand(frame, border=width, fill=color))
+    record['bytes_out'] = imwrite(image, out_file, exf, frames)
+    return record
 
 
 def border(files: list, width: int, color: str, overwrite: bool):
-    with mp.Pool(mp.cpu_count()) as pool:
-        pool.map(partial(_border, width=width, color=color, overwrite=overwrite), files)
+    return run_pool(partial(_border, width=width, color=color, overwrite=overwrite), files, prefetch=True)
 
 
-def bytes2megabytes(n_bytes: float) -> float:
-    return n_bytes / float(1 << 20)
-
-
-def _optimize(src: str, overwrite: bool):
+def _optimize(src: str, overwrite: bool) -> dict:
     image, exf = imread(src)
-    orig_size = os.stat(src).st_size
     path_base, ext = os.path.splitext(src)
     if overwrite:
         new_file_path = src
     else:
         new_file_path = '%s_optimized%s' % (path_base, ext)
-    print('%s --> %s' % (src, new_file_path))
-    imwrite(image, new_file_path, exf)
-    new_size = os.stat(new_file_path).st_size
-    print("%.1f MB --> %.1f MB (optimization: %.1f %%)"
-          % (bytes2megabytes(orig_size), bytes2megabytes(new_size), 100.0 * (orig_size - new_size) / orig_size))
+    record = _record(src, new_file_path)
+    record['bytes_out'] = imwrite(image, new_file_path, exf)
+    return record
 
 
 def optimize(files: list, overwrite: bool):
-    with mp.Pool(mp.cpu_count()) as pool:
-        pool.map(partial(_optimize, overwrite=overwrite), files)
+    return run_pool(partial(_optimize, overwrite=overwrite), files, prefetch=True)
 
 
-def _rename(src: str, pattern: str, overwrite: bool):
+def _rename(src: str, pattern: str, overwrite: bool, strdatetime: str = None) -> dict:
     try:
-        image, exf = imread(src)
         path_base, ext = os.path.splitext(src)
         path_arr = path_base.split(os.sep)
         filename = path_arr[-1]
         pth = os.path.join(*path_arr[:-1])
-        if 'Exif' in exf:
-            strdatetime = exf['Exif'][piexif.ExifIFD.DateTimeOriginal].decode('utf-8')
-        else:
-            strdatetime = exf['0th'][piexif.ImageIFD.DateTime].decode('utf-8')
+        if strdatetime is None:
+            image, exf = imread(src)
+            if 'Exif' in exf:
+                strdatetime = exf['Exif'][piexif.ExifIFD.DateTimeOriginal].decode('utf-8')
+            else:
+                strdatetime = exf['0th'][piexif.ImageIFD.DateTime].decode('utf-8')
         dt = datetime.strptime(strdatetime, "%Y:%m:%d %H:%M:%S")
 
         new_file_name = dt.strftime(pattern)
         new_file_name = new_file_name.replace('ORIG_NAME', filename)
         new_file_path = os.path.join(pth, new_file_name)
-        print('%s --> %s' % (src, new_file_path))
         if overwrite:
             os.rename(src, new_file_path)
         else:
             shutil.copyfile(src, new_file_path)
-    except:
-        print('Error processing image %s:', src)
-        traceback.print_exception(*sys.exc_info())
+        return {'output': new_file_path}
+    except Exception as e:
+        return {'status': 'failed', 'error': '%s: %s' % (type(e).__name__, e)}
 
 
-def rename(files: str, pattern: str, overwrite: bool):
-    with mp.Pool(mp.cpu_count()) as pool:
-        pool.map(partial(_rename, pattern=pattern, overwrite=overwrite), files)
+def rename(files: str, pattern: str, overwrite: bool, index: str = None):
+    if index:
+        progress = Progress(len(files))
+        with refreshed_index(index, files) as conn:
+            for row in query_files(conn, files):
+                progress.add(row['file'], _rename(row['file'], pattern, overwrite, row['datetime']))
+        return progress.close()
+    return run_pool(partial(_rename, pattern=pattern, overwrite=overwrite), files)
 
 def _info(src: str):
     image, exf = imread(src)
@@ -506,6 +648,63 @@ def _info(src: str):
     _exif_show(exf)
 
 
-def info(files: list):
+def _info_row(row):
+    if row['error']:
+        print(f"Cannot read image: {row['error']}")
+        return
+    print("Data info:")
+    print(f"- Size (width, height): {(row['width'], row['height'])}")
+    print(f"- Mode: {row['mode']}")
+    print("Exif info:")
+    if row['datetime'] is None and row['orientation'] is None:
+        print("No exif data found")
+    if row['datetime'] is not None:
+        print(f"DateTime: {row['datetime']}")
+    if row['orientation'] is not None:
+        print(f"Orientation: {row['orientation']}")
+
+
+def info(files: list, index: str = None):
+    if index:
+        with refreshed_index(index, files) as conn:
+            for row in query_files(conn, files):
+                _info_row(row)
+        return
     for file in files:
         _info(file)
+
+
+def _stats(src: str, max_size: int) -> dict:
+    record = _record(src, None)
+    image, _ = imread(src)
+    size, fmt, mode = image.size, image.format, image.mode
+    if max_size:
+        image.thumbnail((max_size, max_size))  # JPEG decodes at reduced scale (draft).
+    record['stats'] = Stats.from_image(image, size, fmt, mode)
+    return record
+
+
+def stats(files: list, max_size: int, output: str):
+    total = Stats()
+    progress = Progress(len(files), json_lines=False)  # Stdout is reserved for the statistics.
+    for src, result, error in imap_pool(partial(_stats, max_size=max_size), files, prefetch=True):
+        if error is None:
+            total.merge(result.pop('stats'))
+        progress.add(src, result, error)
+    failures = progress.close()
+    result = json.dumps(total.to_dict())
+    if output:
+        with open(output, 'w') as f:
+            f.write(result)
+    else:
+        print(result)
+    return failures
+
+
+def build_index(files: list, index: str):
+    conn = open_index(index)
+    try:
+        n_probed = update_index(conn, files)
+    finally:
+        conn.close()
+    print('%d files, %d probed --> %s' % (len(files), n_probed, index), file=sys.stderr)
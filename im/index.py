@@ -0,0 +1,112 @@
+import os
+import sqlite3
+from contextlib import contextmanager
+
+import piexif
+
+from im.pool import imap_pool
+from im.utils import imread
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    format TEXT,
+    mode TEXT,
+    datetime TEXT,
+    orientation INTEGER,
+    error TEXT
+)
+'''
+COLUMNS = ('path', 'size', 'mtime_ns', 'width', 'height', 'format', 'mode', 'datetime', 'orientation', 'error')
+BATCH_SIZE = 1000  # Rows written per transaction.
+
+
+def _error_row(path: str, error: str, st: os.stat_result = None) -> tuple:
+    """Row of file which cannot be probed, size and mtime -1 when it cannot be stat-ed (then probed next time)."""
+    size, mtime_ns = (st.st_size, st.st_mtime_ns) if st is not None else (-1, -1)
+    return path, size, mtime_ns, None, None, None, None, None, None, error
+
+
+def _probe(path: str):
+    """Header only probe, pixel data is never decoded."""
+    st = os.stat(path)
+    try:
+        image, exf = imread(path)
+        with image:
+            width, height = image.size
+            fmt, mode = image.format, image.mode
+        strdatetime, orientation = None, None
+        if exf:
+            raw = exf['Exif'].get(piexif.ExifIFD.DateTimeOriginal) or exf['0th'].get(piexif.ImageIFD.DateTime)
+            strdatetime = raw.decode('utf-8') if raw else None
+            orientation = exf['0th'].get(piexif.ImageIFD.Orientation)
+        return path, st.st_size, st.st_mtime_ns, width, height, fmt, mode, strdatetime, orientation, None
+    except Exception as e:
+        return _error_row(path, str(e), st)
+
+
+def open_index(index: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(index)
+    conn.row_factory = sqlite3.Row
+    conn.execute(SCHEMA)
+    return conn
+
+
+def update_index(conn: sqlite3.Connection, files: list) -> int:
+    """Probe new and changed (size, mtime) files in parallel and store them. Returns number of probed files, files
+    which cannot be stat-ed (missing) are stored as error rows too."""
+    known = {row['path']: (row['size'], row['mtime_ns']) for row in conn.execute('SELECT path, size, mtime_ns FROM images')}
+    stale, rows = [], []
+    for file in files:
+        path = os.path.abspath(file)
+        try:
+            st = os.stat(path)
+        except OSError as e:
+            rows.append(_error_row(path, '%s: %s' % (type(e).__name__, e)))
+            continue
+        if known.get(path) != (st.st_size, st.st_mtime_ns):
+            stale.append(path)
+    n_missing = len(rows)
+    if not stale and not n_missing:
+        return 0
+    insert = 'INSERT OR REPLACE INTO images (%s) VALUES (%s)' % (', '.join(COLUMNS), ', '.join('?' * len(COLUMNS)))
+    for path, row, error in imap_pool(_probe, stale):
+        if error is not None:  # Probe timed out or crashed worker, remember it to not probe it again.
+            try:
+                st = os.stat(path)
+            except OSError:
+                st = None
+            row = _error_row(path, error, st)
+        rows.append(row)
+        if len(rows) >= BATCH_SIZE:
+            with conn:
+                conn.executemany(insert, rows)
+            rows.clear()
+    with conn:
+        conn.executemany(insert, rows)
+    return len(stale) + n_missing
+
+
+@contextmanager
+def refreshed_index(index: str, files: list):
+    """Connection to index updated for files (see update_index), closed on exit."""
+    conn = open_index(index)
+    try:
+        update_index(conn, files)
+        yield conn
+    finally:
+        conn.close()
+
+
+def query_files(conn: sqlite3.Connection, files: list, where: str = '1'):
+    """Yield index rows (plus original input "file" column) of input files matching SQL where clause."""
+    conn.execute('CREATE TEMP TABLE IF NOT EXISTS args (i INTEGER PRIMARY KEY, path TEXT, file TEXT)')
+    with conn:
+        conn.execute('DELETE FROM args')
+        conn.executemany('INSERT INTO args (path, file) VALUES (?, ?)', ((os.path.abspath(f), f) for f in files))
+    yield from conn.execute('SELECT args.file, images.* FROM args JOIN images USING (path) WHERE %s ORDER BY args.i'
+                            % where)
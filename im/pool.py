@@ -0,0 +1,278 @@
+import json
+import multiprocessing as mp
+import socket
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import islice
+from multiprocessing.connection import wait
+
+from im.utils import apply_outputs, deferred_io
+
+try:
+    import resource
+except ImportError:  # Not available on Windows, memory cap is then ignored.
+    resource = None
+
+# Defaults for all pooled commands, set from command line (im --timeout ... COMMAND).
+LIMITS = {
+    'timeout': None,     # Wall-clock seconds per file.
+    'memory': None,      # Address space cap per worker (MB).
+    'max_tasks': 100,    # Files processed by worker before it is replaced by fresh one.
+    'retries': 1,        # Extra attempts for files which timed out or crashed worker.
+    'io_depth': 8,       # Files read ahead / written behind by parent threads (prefetch commands), 0 disables it.
+}
+REPORT = {'json': False}  # Emit result records as JSON lines instead of progress line (im --json COMMAND).
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _notify(sock, future):
+    """Future done callback, wakes up supervision loop waiting for workers."""
+    try:
+        sock.send(b'\0')
+    except OSError:  # Buffer full (wake-up pending anyway) or loop already finished.
+        pass
+
+
+def _drain(sock):
+    try:
+        while sock.recv(4096):
+            pass
+    except BlockingIOError:
+        pass
+
+
+def _work(conn, func, memory):
+    if memory and resource is not None:
+        n_bytes = memory << 20
+        resource.setrlimit(resource.RLIMIT_AS, (n_bytes, n_bytes))
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+        src, data = task
+        start = time.perf_counter()
+        try:
+            outputs = None
+            if data is None:
+                result = func(src)
+            else:
+                with deferred_io(src, data) as outputs:
+                    result = func(src)
+            if isinstance(result, dict):
+                result.setdefault('duration', round(time.perf_counter() - start, 6))
+                if data is not None:
+                    result.setdefault('bytes_in', len(data))  # Input size known without stat.
+            conn.send((True, result, outputs))
+        except Exception as e:
+            conn.send((False, '%s: %s' % (type(e).__name__, e), None))
+
+
+class _Worker:
+
+    def __init__(self, func, memory):
+        self.conn, child_conn = mp.Pipe()
+        self.process = mp.Process(target=_work, args=(child_conn, func, memory), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.task = None        # (src, attempt) being processed.
+        self.started = 0.0
+        self.n_tasks = 0
+
+    def submit(self, task, data=None):
+        self.task = task
+        self.started = time.monotonic()
+        self.n_tasks += 1
+        self.conn.send((task[0], data))
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(1)
+        self.kill()
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+def imap_pool(func, files: list, prefetch: bool = False, **limits):
+    """Supervised alternative to Pool.imap_unordered, yields (src, result, error) as files are finished. Result
+    records (dict) returned by func get duration (s) of the call and bytes_in of prefetched input.
+    Worker exceeding timeout is killed, dead worker (memory cap, segfault) is replaced. Both cases are retried,
+    then the file is given up (quarantined) with the error. Exceptions raised by func are not retried.
+
+    With prefetch, parent threads read input files ahead into memory and func runs in deferred_io() context: it
+    decodes from the prefetched bytes and its outputs are written behind by parent threads, keeping workers busy
+    with decoding / encoding only on slow storage."""
+    limits = {**LIMITS, **limits}
+    timeout, max_tasks, retries = limits['timeout'], limits['max_tasks'], limits['retries']
+    depth = limits['io_depth'] if prefetch else 0
+    pending = deque([src, 0, None] for src in files)  # src, attempt, prefetch future
+    writes = deque()  # src, result, write future
+    workers = [_Worker(func, limits['memory']) for _ in range(min(mp.cpu_count(), len(pending)))]
+    ahead = max(depth, len(workers))  # Files considered for dispatch, reads in flight (at least one per worker).
+    readers = ThreadPoolExecutor(ahead) if depth else None
+    writers = ThreadPoolExecutor(depth) if depth else None
+    wakeup, waker = socket.socketpair() if depth else (None, None)  # Finished read / write wakes the loop.
+    if depth:
+        wakeup.setblocking(False)
+        waker.setblocking(False)
+    notify = partial(_notify, waker)
+    try:
+        while True:
+            if readers is not None:
+                for item in islice(pending, ahead):
+                    if item[2] is None:
+                        item[2] = readers.submit(_read, item[0])
+                        item[2].add_done_callback(notify)
+            # Workers get only files already read (in any order), the supervision loop never blocks on a read.
+            ready = [item for item in islice(pending, ahead) if item[2] is None or item[2].done()]
+            for i, worker in enumerate(workers):
+                while worker.task is None and ready:
+                    item = ready.pop(0)
+                    pending.remove(item)
+                    src, attempt, read = item
+                    try:
+                        data = read.result() if read is not None else None
+                    except OSError as e:
+                        yield src, None, '%s: %s' % (type(e).__name__, e)
+                        continue
+                    if max_tasks and worker.n_tasks >= max_tasks:
+                        worker.stop()
+                        workers[i] = worker = _Worker(func, limits['memory'])
+                    worker.submit((src, attempt), data)
+            while writes and (writes[0][2].done() or len(writes) > depth):
+                src, result, write = writes.popleft()
+                try:
+                    write.result()
+                    yield src, result, None
+                except Exception as e:
+                    yield src, None, '%s: %s' % (type(e).__name__, e)
+            busy = [worker for worker in workers if worker.task is not None]
+            if not busy and not writes and not pending:
+                break
+            wait_timeout = None
+            if timeout and busy:
+                wait_timeout = max(0.0, min(worker.started for worker in busy) + timeout - time.monotonic())
+            waitables = [worker.conn for worker in busy] + [worker.process.sentinel for worker in busy]
+            wait(waitables + [wakeup] if depth else waitables, wait_timeout)
+            if depth:
+                _drain(wakeup)
+            for i, worker in enumerate(workers):
+                if worker.task is None:
+                    continue
+                src, attempt = worker.task
+                failure = None
+                try:
+                    if worker.conn.poll():
+                        worker.task = None
+                        ok, value, outputs = worker.conn.recv()
+                        if outputs:
+                            writes.append((src, value, writers.submit(apply_outputs, outputs)))
+                            writes[-1][2].add_done_callback(notify)
+                        else:
+                            yield (src, value, None) if ok else (src, None, value)
+                        continue
+                    if not worker.process.is_alive():
+                        failure = 'worker died (exit code %s)' % worker.process.exitcode
+                    elif timeout and time.monotonic() - worker.started > timeout:
+                        failure = 'timeout (%s s)' % timeout
+                except (EOFError, OSError):
+                    failure = 'worker died (exit code %s)' % worker.process.exitcode
+                if failure is None:
+                    continue
+                worker.kill()
+                workers[i] = _Worker(func, limits['memory'])
+                if attempt < retries:
+                    pending.append([src, attempt + 1, None])
+                else:
+                    yield src, None, failure
+    finally:
+        for worker in workers:
+            worker.kill()
+        if readers is not None:
+            readers.shutdown(cancel_futures=True)
+            writers.shutdown()  # Let started writes finish, they are atomic anyway.
+            wakeup.close()
+            waker.close()
+
+
+class Progress:
+    """Collects result records of processed files. Renders single progress line (throughput, ETA) on terminal or
+    emits JSON lines, messages of records are printed to stdout."""
+
+    def __init__(self, total: int, json_lines: bool = None):
+        self.total = total
+        self.json_lines = REPORT['json'] if json_lines is None else json_lines
+        self.live = not self.json_lines and sys.stderr.isatty()
+        self.started = time.monotonic()
+        self.n_done = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.failures = {}
+
+    def add(self, src: str, result, error: str = None):
+        record = {'input': src, 'output': None, 'status': 'ok' if error is None else 'failed', 'bytes_in': None,
+                  'bytes_out': None, 'duration': None, 'error': error, 'message': None}
+        if isinstance(result, dict):
+            record.update(result)
+        self.n_done += 1
+        self.bytes_in += record['bytes_in'] or 0
+        self.bytes_out += record['bytes_out'] or 0
+        if record['status'] != 'ok':  # Raised in func (error) or reported by func itself.
+            self.failures[src] = record['error']
+        if self.json_lines:
+            print(json.dumps(record), flush=True)
+            return
+        if record['message'] is not None:
+            self._clear()
+            print(record['message'], flush=True)
+        if self.live:
+            sys.stderr.write('\r' + self.status())
+            sys.stderr.flush()
+
+    def status(self) -> str:
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        rate = self.n_done / elapsed
+        eta = (self.total - self.n_done) / rate if rate else 0.0
+        line = '%d/%d files, %.1f files/s, %.1f MB/s, ETA %d:%02d' \
+               % (self.n_done, self.total, rate, self.bytes_in / elapsed / (1 << 20), eta // 60, eta % 60)
+        if self.bytes_out:
+            line += ', %.1f MB --> %.1f MB' % (self.bytes_in / (1 << 20), self.bytes_out / (1 << 20))
+        if self.failures:
+            line += ', %d failed' % len(self.failures)
+        return line
+
+    def _clear(self):
+        if self.live:
+            sys.stderr.write('\r\033[K')
+
+    def close(self) -> dict:
+        """Print final status and failure summary. Returns {src: error} of failed files."""
+        self._clear()
+        if not self.json_lines:
+            print(self.status(), file=sys.stderr)
+        if self.failures:
+            print('%d of %d files failed:' % (len(self.failures), self.total), file=sys.stderr)
+            for src, error in self.failures.items():
+                print('  %s: %s' % (src, error), file=sys.stderr)
+        return self.failures
+
+
+def run_pool(func, files: list, prefetch: bool = False, **limits) -> dict:
+    """Process all files using imap_pool, report progress and failures. Returns {src: error} of failed files."""
+    progress = Progress(len(files))
+    for src, result, error in imap_pool(func, files, prefetch, **limits):
+        progress.add(src, result, error)
+    return progress.close()
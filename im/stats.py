@@ -0,0 +1,89 @@
+from collections import Counter
+
+import numpy as np
+
+CHANNELS = ('R', 'G', 'B')
+ASPECT_EDGES = (0.5, 0.75, 0.9, 1.1, 1.4, 1.6, 1.9, 2.5)          # Width / height histogram bin edges.
+MEGAPIXEL_EDGES = (0.1, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 50.0)     # Width * height / 1e6 histogram bin edges.
+
+
+class Stats:
+    """Mergeable collection statistics. Pixel mean/variance use parallel Welford (Chan et al.) update, so per image
+    results computed in workers can be combined in any order with constant memory."""
+
+    def __init__(self):
+        self.n_images = 0
+        self.n_pixels = 0
+        self.mean = np.zeros(len(CHANNELS))
+        self.m2 = np.zeros(len(CHANNELS))  # Sum of squared differences from mean.
+        self.histogram = np.zeros((len(CHANNELS), 256), dtype=np.int64)
+        self.width = [None, None, 0]  # min, max, sum
+        self.height = [None, None, 0]
+        self.aspect = np.zeros(len(ASPECT_EDGES) + 1, dtype=np.int64)
+        self.megapixels = np.zeros(len(MEGAPIXEL_EDGES) + 1, dtype=np.int64)
+        self.formats = Counter()
+        self.modes = Counter()
+
+    @classmethod
+    def from_image(cls, image, size: tuple, fmt: str, mode: str) -> 'Stats':
+        """Statistics of single image. Pixels are taken from (possibly reduced) image, size, format and mode are
+        the original ones."""
+        stats = cls()
+        pixels = np.asarray(image.convert('RGB'), dtype=np.uint8).reshape(-1, len(CHANNELS))
+        offsets = np.arange(len(CHANNELS), dtype=np.uint16) * 256
+        stats.histogram = np.bincount((pixels + offsets).ravel(), minlength=len(CHANNELS) * 256).reshape(-1, 256)
+        # Exact moments from the histogram, no float copy of the pixels.
+        values = np.arange(256)
+        stats.n_images = 1
+        stats.n_pixels = len(pixels)
+        stats.mean = stats.histogram @ values / stats.n_pixels
+        stats.m2 = (stats.histogram * (values - stats.mean[:, None]) ** 2).sum(axis=1)
+        w, h = size
+        stats.width = [w, w, w]
+        stats.height = [h, h, h]
+        stats.aspect[np.searchsorted(ASPECT_EDGES, w / h, side='right')] = 1
+        stats.megapixels[np.searchsorted(MEGAPIXEL_EDGES, w * h / 1e6, side='right')] = 1
+        stats.formats[fmt] = 1
+        stats.modes[mode] = 1
+        return stats
+
+    def merge(self, other: 'Stats'):
+        n_pixels = self.n_pixels + other.n_pixels
+        if other.n_pixels:
+            delta = other.mean - self.mean
+            self.mean = self.mean + delta * other.n_pixels / n_pixels
+            self.m2 = self.m2 + other.m2 + delta ** 2 * self.n_pixels * other.n_pixels / n_pixels
+        self.n_pixels = n_pixels
+        self.n_images += other.n_images
+        self.histogram += other.histogram
+        for mine, theirs in ((self.width, other.width), (self.height, other.height)):
+            if theirs[0] is None:
+                continue
+            mine[0] = theirs[0] if mine[0] is None else min(mine[0], theirs[0])
+            mine[1] = theirs[1] if mine[1] is None else max(mine[1], theirs[1])
+            mine[2] += theirs[2]
+        self.aspect += other.aspect
+        self.megapixels += other.megapixels
+        self.formats.update(other.formats)
+        self.modes.update(other.modes)
+        return self
+
+    def to_dict(self) -> dict:
+        std = np.sqrt(self.m2 / self.n_pixels) if self.n_pixels else self.m2
+        return {
+            'images': self.n_images,
+            'pixels': self.n_pixels,
+            'mean': dict(zip(CHANNELS, self.mean.round(4).tolist(), strict=True)),
+            'std': dict(zip(CHANNELS, std.round(4).tolist(), strict=True)),
+            'histogram': dict(zip(CHANNELS, self.histogram.tolist(), strict=True)),
+            'width': self._dimension(self.width),
+            'height': self._dimension(self.height),
+            'aspect': {'edges': list(ASPECT_EDGES), 'counts': self.aspect.tolist()},
+            'megapixels': {'edges': list(MEGAPIXEL_EDGES), 'counts': self.megapixels.tolist()},
+            'formats': dict(self.formats.most_common()),
+            'modes': dict(self.modes.most_common()),
+        }
+
+    def _dimension(self, values: list) -> dict:
+        v_min, v_max, v_sum = values
+        return {'min': v_min, 'max': v_max, 'mean': v_sum / self.n_images if self.n_images else None}
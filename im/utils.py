@@ -1,23 +1,228 @@
+import os
+import shutil
+import uuid
+from contextlib import contextmanager
+from io import BytesIO
+
 import numpy as np
 import piexif
-from PIL import Image
+from PIL import Image, UnidentifiedImageError
 
+# Encoder settings of named presets per target format (Pillow save params). Missing fast / small presets keep
+# encoder defaults, lossless must be listed explicitly (see encoder_params).
+PRESETS = ('fast', 'default', 'small', 'lossless')
+ENCODER_PRESETS = {
+    'PNG': {
+        'fast': {'compress_level': 1},
+        'small': {'optimize': True},
+        'lossless': {},
+    },
+    'WEBP': {
+        'fast': {'method': 0},
+        'small': {'method': 6, 'quality': 75},
+        'lossless': {'lossless': True, 'method': 6, 'quality': 100},
+    },
+    'JPEG': {
+        'small': {'optimize': True, 'progressive': True, 'subsampling': '4:2:0'},
+    },
+    'TIFF': {
+        'fast': {'compression': 'packbits'},
+        'small': {'compression': 'tiff_adobe_deflate'},
+        'lossless': {},
+    },
+}
+FRAME_INFO = ('duration', 'loop', 'disposal', 'blend')  # Animation properties carried over to output frames.
+# Image modes encoders can write, formats not listed accept any mode (see save_mode).
+SAVE_MODES = {
+    'JPEG': ('1', 'L', 'RGB', 'CMYK'),
+    'PNG': ('1', 'L', 'LA', 'P', 'I;16', 'RGB', 'RGBA'),
+    'GIF': ('1', 'L', 'LA', 'P', 'RGB', 'RGBA'),
+    'BMP': ('1', 'L', 'P', 'RGB', 'RGBA'),
+    'PPM': ('1', 'L', 'RGB', 'RGBA'),
+    'TGA': ('1', 'L', 'LA', 'P', 'RGB', 'RGBA'),
+}
+DISPOSAL = {'GIF': (1, 2, 3), 'PNG': (0, 1, 2)}  # Frame disposal codes of none, background, previous per format.
 
-def imread(filepath):
-    image = Image.open(filepath)
+
+class UsageError(ValueError):
+    """Invalid command options, reported by command line as usage error."""
+
+
+def encoder_params(fmt, preset):
+    """Save params of named preset for format, UsageError when lossless output is not possible."""
+    presets = ENCODER_PRESETS.get(fmt, {})
+    if preset == 'lossless' and preset not in presets:
+        raise UsageError('lossless preset is not supported for %s format' % fmt)
+    return presets.get(preset, {})
+
+
+def save_mode(image, fmt):
+    """Image converted to mode the format encoder can write: integer / float gray to L, others to RGB(A) keeping
+    transparency where the format stores it."""
+    modes = SAVE_MODES.get(fmt)
+    if modes is None or image.mode in modes:
+        return image
+    if image.mode.startswith(('I', 'F')):
+        return image.convert('L')
+    return image.convert('RGBA' if image.has_transparency_data and 'RGBA' in modes else 'RGB')
+
+
+def _load_exif(image):
     try:
         exf = piexif.load(image.info['exif'])
     except:
         exf = None
-    return image, exf
+    return exf
+
+
+class _DeferredIO:
+    """Pool worker state when parent does the I/O: prefetched input bytes and collected output operations."""
+    inputs = {}
+    outputs = None
+
+
+@contextmanager
+def deferred_io(src, data):
+    """Serve imread(src) from prefetched bytes, collect written / removed files instead of touching the disk.
+    Yields list of output operations (('write', path, data) or ('remove', path, None)) to apply in order."""
+    _DeferredIO.inputs, _DeferredIO.outputs = {src: data}, []
+    try:
+        yield _DeferredIO.outputs
+    finally:
+        _DeferredIO.inputs, _DeferredIO.outputs = {}, None
+
+
+def is_deferred() -> bool:
+    """True in pool worker when parent does the I/O (input is prefetched, outputs are written behind)."""
+    return _DeferredIO.outputs is not None
+
+
+def _open(filepath):
+    data = _DeferredIO.inputs.get(filepath)
+    if data is None:
+        return Image.open(filepath)
+    try:
+        return Image.open(BytesIO(data))
+    except UnidentifiedImageError:
+        raise UnidentifiedImageError('cannot identify image file %r' % filepath) from None
+
+
+def imread(filepath):
+    image = _open(filepath)
+    return image, _load_exif(image)
+
 
+def imread_gray(filepath):
+    image = _open(filepath)
+    image.draft('L', image.size)  # JPEG decodes luminance only, no chroma upsampling / color conversion.
+    return image, _load_exif(image)
 
-def imwrite(image, filename, exif=None):
+
+def imwrite(image, filename, exif=None, frames=None, **params) -> int:
+    """Encode image in memory and write (or defer) it atomically. Returns encoded size in bytes."""
     if exif:
         _try_fix_exif(exif)
-        image.save(filename, exif=piexif.dump(exif))
+        params['exif'] = piexif.dump(exif)
+    ext = os.path.splitext(filename)[1].lower()
+    fmt = Image.registered_extensions().get(ext)
+    if fmt is None:
+        raise ValueError('unknown file extension: %s' % ext)
+    if frames is not None and fmt in Image.SAVE_ALL:
+        params = {**_animation_params(image, frames, fmt), **params}
+    buffer = BytesIO()
+    image.save(buffer, format=fmt, **params)
+    data = buffer.getvalue()
+    if _DeferredIO.outputs is not None:
+        _DeferredIO.outputs.append(('write', filename, data))
+    else:
+        write_atomic(filename, data)
+    return len(data)
+
+
+def _animation_params(image, frames, fmt) -> dict:
+    """Save params of first frame image followed by frames (see map_frames) in target format."""
+    params = {'save_all': True}
+    source, disposal = frames.format, image.info.get('disposal')
+    if fmt == 'WEBP':  # Takes duration and loop from save params only (it makes list of the frames anyway).
+        frames = list(frames)
+        params['duration'] = [frame.info.get('duration', 0) for frame in (image, *frames)]
+        if 'loop' in image.info:
+            params['loop'] = image.info['loop']
+    if source != fmt and disposal is not None and source in DISPOSAL and fmt in DISPOSAL:
+        # Same meaning in target codes, GIF 0 (not specified) is none. Encoders take it from the first frame, blend
+        # is APNG only.
+        params['disposal'] = DISPOSAL[fmt][DISPOSAL[source].index(disposal) if disposal in DISPOSAL[source] else 0]
+    params['append_images'] = frames
+    return params
+
+
+def remove_file(path):
+    """Remove file, deferred after preceding imwrite() outputs when parent does the I/O."""
+    if _DeferredIO.outputs is not None:
+        _DeferredIO.outputs.append(('remove', path, None))
     else:
-        image.save(filename)
+        os.remove(path)
+
+
+def apply_outputs(outputs):
+    for op, path, data in outputs:
+        if op == 'write':
+            write_atomic(path, data)
+        else:
+            os.remove(path)
+
+
+def write_atomic(path, data):
+    """Write to temporary file next to path and rename it, path is never left partially written (overwrite)."""
+    dirname, basename = os.path.split(os.path.abspath(path))
+    tmp = os.path.join(dirname, '.%s.%s.tmp' % (basename, uuid.uuid4().hex[:8]))
+    try:
+        with open(tmp, 'xb') as f:
+            f.write(data)
+        if os.path.exists(path):
+            shutil.copymode(path, tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def is_animated(image):
+    return getattr(image, 'is_animated', False)
+
+
+def map_frames(image, func):
+    """Apply func frame by frame. Returns the first result frame and a lazy sequence of the remaining ones
+    (None for single frame images). Source frames are decoded only when the sequence is iterated."""
+    if not is_animated(image):
+        return func(image), None
+    image.seek(0)
+    return _copy_frame_info(func(image.copy()), image), _FrameSequence(image, func)
+
+
+class _FrameSequence:
+    """Re-iterable (APNG encoder walks append_images twice), one frame is decoded and transformed at a time."""
+
+    def __init__(self, image, func):
+        self.image = image
+        self.func = func
+        self.format = image.format  # Frame info (disposal codes) is in terms of source format.
+
+    def __iter__(self):
+        for index in range(1, self.image.n_frames):
+            self.image.seek(index)
+            # Seeking mutates the image in place (and GIF frames keep a stale palette), hand func a detached copy.
+            yield _copy_frame_info(self.func(self.image.copy()), self.image)
+
+
+def _copy_frame_info(dst, src):
+    for key in FRAME_INFO:
+        if key in src.info:
+            dst.info[key] = src.info[key]
+    if 'disposal' not in src.info and hasattr(src, 'disposal_method'):  # GIF keeps disposal out of info.
+        dst.info['disposal'] = src.disposal_method
+    return dst
 
 
 def _try_fix_exif(exif):
@@ -1,10 +1,25 @@
+import json
 import os
 
 import numpy as np
+import piexif
 import pytest
 from PIL import Image
 
-from im.im import border, convert, crop, flip, gray, info, resize, stack
+from im.im import (
+    border,
+    build_index,
+    convert,
+    crop,
+    filter,
+    flip,
+    gray,
+    info,
+    resize,
+    stack,
+)
+from im.pool import REPORT
+from im.utils import imread_gray
 
 
 @pytest.fixture
@@ -25,6 +40,16 @@ def sample_image_jpg(tmp_path):
     return path
 
 
+@pytest.fixture
+def sample_gif(tmp_path):
+    """Create a simple animated GIF (3 frames)."""
+    frames = [Image.fromarray(np.full((40, 60, 3), v, dtype=np.uint8)) for v in (0, 120, 240)]
+    path = str(tmp_path / "anim.gif")
+    frames[0].save(path, save_all=True, append_images=frames[1:], duration=[100, 200, 300], loop=0,
+                   disposal=2)
+    return path
+
+
 def test_gray(sample_image, tmp_path):
     gray(files=[sample_image], overwrite=False)
     out = str(tmp_path / "test_gray.png")
@@ -39,6 +64,18 @@ def test_gray_overwrite(sample_image):
     assert img.mode == "L"
 
 
+def test_gray_jpg_keeps_exif(tmp_path):
+    img = Image.fromarray(np.random.randint(0, 255, (100, 150, 3), dtype=np.uint8))
+    path = str(tmp_path / "test.jpg")
+    img.save(path, exif=piexif.dump({"0th": {piexif.ImageIFD.ImageDescription: b"scan"}}))
+    assert imread_gray(path)[0].mode == "L"  # Draft decode requested, before any pixel data is loaded.
+    gray(files=[path], overwrite=False)
+    out = Image.open(str(tmp_path / "test_gray.jpg"))
+    assert out.mode == "L"
+    assert out.size == (150, 100)
+    assert piexif.load(out.info["exif"])["0th"][piexif.ImageIFD.ImageDescription] == b"scan"
+
+
 def test_resize(sample_image, tmp_path):
     resize(files=[sample_image], overwrite=False, size=50, width=0, height=0)
     out = str(tmp_path / "test_resized.png")
@@ -93,6 +130,45 @@ def test_convert(sample_image, tmp_path):
     assert os.path.exists(out)
 
 
+def test_convert_preset_keeps_exif(tmp_path, capsys, monkeypatch):
+    monkeypatch.setitem(REPORT, "json", True)
+    src = str(tmp_path / "test.jpg")
+    Image.fromarray(np.random.randint(0, 255, (100, 150, 3), dtype=np.uint8)).save(
+        src, exif=piexif.dump({"0th": {piexif.ImageIFD.ImageDescription: b"photo"}}))
+    size = os.path.getsize(src)
+    assert convert(files=[src], extension=".webp", overwrite=True, preset="lossless") == {}
+    record = json.loads(capsys.readouterr().out)
+    assert record["status"] == "ok"
+    assert record["output"] == str(tmp_path / "test.webp")
+    assert record["bytes_in"] == size
+    assert record["bytes_out"] == os.path.getsize(record["output"])
+    assert record["encode_time"] <= record["duration"]
+    assert not os.path.exists(src)
+    img = Image.open(str(tmp_path / "test.webp"))
+    assert img.size == (150, 100)
+    assert piexif.load(img.info["exif"])["0th"][piexif.ImageIFD.ImageDescription] == b"photo"
+
+
+def test_convert_lossless_jpg_rejected(sample_image):
+    with pytest.raises(ValueError, match="lossless"):
+        convert(files=[sample_image], extension=".jpg", overwrite=False, preset="lossless")
+
+
+def test_convert_rgba_to_jpg(tmp_path):
+    src = str(tmp_path / "alpha.png")
+    Image.fromarray(np.zeros((10, 10, 4), dtype=np.uint8)).save(src)
+    convert(files=[src], extension=".jpg", overwrite=False, preset="small")
+    assert Image.open(str(tmp_path / "alpha.jpg")).mode == "RGB"
+
+
+@pytest.mark.parametrize("mode, ext, expected", [("CMYK", ".jpg", "RGB"), ("F", ".tif", "L"), ("PA", ".tif", "RGBA")])
+def test_convert_mode_to_png(tmp_path, mode, ext, expected):
+    src = str(tmp_path / ("image" + ext))
+    Image.new(mode, (10, 10)).save(src)
+    assert convert(files=[src], extension=".png", overwrite=False) == {}
+    assert Image.open(str(tmp_path / "image.png")).mode == expected
+
+
 def test_stack_horizontal(tmp_path):
     img1 = Image.fromarray(np.zeros((100, 50, 3), dtype=np.uint8))
     img2 = Image.fromarray(np.zeros((100, 80, 3), dtype=np.uint8))
@@ -107,8 +183,136 @@ def test_stack_horizontal(tmp_path):
     assert result.size[1] == 100  # height preserved
 
 
+def test_stack_montage(tmp_path, capsys, monkeypatch):
+    monkeypatch.setitem(REPORT, "json", True)
+    files = []
+    for i, shape in enumerate([(100, 200, 3), (50, 100, 3), (100, 200, 4), (40, 80)]):
+        path = str(tmp_path / ("%d.%s" % (i, "jpg" if len(shape) != 3 or shape[2] == 3 else "png")))
+        Image.fromarray(np.full(shape, 200, dtype=np.uint8)).save(path)
+        files.append(path)
+    out = str(tmp_path / "montage.png")
+    stack(files=files, output=out, vertical=False, montage=True, cols=3, tile_size=20, padding=2, labels=True,
+          background="black")
+    result = Image.open(out)
+    assert result.size == (3 * 22 + 2, 2 * (10 + 12 + 2) + 2)  # Cell 20x10 + label, 3 cols x 2 rows.
+    assert result.getpixel((2 + 10, 2 + 5)) == (200, 200, 200)
+    assert result.getpixel((2 + 22 + 10, 2 + 24 + 5)) == (0, 0, 0)  # Empty cell.
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]  # Only records on stdout.
+    assert sorted(record["input"] for record in records) == files
+    assert all(record["bytes_in"] == os.path.getsize(record["input"]) for record in records)
+    assert all(record["duration"] is not None for record in records)
+
+
 def test_info(sample_image, capsys):
     info(files=[sample_image])
     captured = capsys.readouterr()
     assert "Size" in captured.out
     assert "Mode" in captured.out
+
+
+def test_resize_animated(sample_gif, tmp_path):
+    resize(files=[sample_gif], overwrite=False, size=30, width=0, height=0)
+    img = Image.open(str(tmp_path / "anim_resized.gif"))
+    assert img.size == (30, 20)
+    assert img.n_frames == 3
+    assert img.info["loop"] == 0
+    durations, disposals = [], []
+    for i in range(img.n_frames):
+        img.seek(i)
+        durations.append(img.info["duration"])
+        disposals.append(img.disposal_method)
+    assert durations == [100, 200, 300]
+    assert disposals == [2, 2, 2]
+
+
+def test_resize_animated_webp(tmp_path):
+    frames = [Image.fromarray(np.full((40, 60, 3), v, dtype=np.uint8)) for v in (0, 120, 240)]
+    path = str(tmp_path / "anim.webp")
+    frames[0].save(path, save_all=True, append_images=frames[1:], duration=[100, 200, 300], loop=2, lossless=True)
+    resize(files=[path], overwrite=False, size=30, width=0, height=0)
+    img = Image.open(str(tmp_path / "anim_resized.webp"))
+    assert img.size == (30, 20)
+    assert img.info["loop"] == 2
+    durations = []
+    for i in range(img.n_frames):
+        img.seek(i)
+        img.load()  # WebP reads frame duration with its data.
+        durations.append(img.info["duration"])
+    assert durations == [100, 200, 300]
+
+
+@pytest.mark.parametrize("gif_disposal, png_disposal", [(2, 1), (3, 2)])
+def test_convert_animated_gif_disposal_to_png(tmp_path, gif_disposal, png_disposal):
+    frames = [Image.fromarray(np.full((40, 60, 3), v, dtype=np.uint8)) for v in (0, 120, 240)]
+    path = str(tmp_path / "anim.gif")
+    frames[0].save(path, save_all=True, append_images=frames[1:], duration=100, disposal=gif_disposal)
+    assert convert(files=[path], extension=".png", overwrite=False) == {}
+    img = Image.open(str(tmp_path / "anim.png"))
+    assert img.n_frames == 3
+    disposals = []
+    for i in range(img.n_frames):
+        img.seek(i)
+        disposals.append(img.info["disposal"])
+    assert disposals == [png_disposal] * 3
+
+
+def test_border_animated_overwrite(sample_gif):
+    border(files=[sample_gif], width=5, color="red", overwrite=True)
+    img = Image.open(sample_gif)
+    assert img.size == (70, 50)
+    assert img.n_frames == 3
+
+
+def test_filter_index(sample_image, tmp_path, capsys):
+    small = str(tmp_path / "small.png")
+    Image.fromarray(np.zeros((10, 10, 3), dtype=np.uint8)).save(small)
+    index = str(tmp_path / "im.sqlite")
+    build_index(files=[sample_image, small], index=index)
+    captured = capsys.readouterr()
+    assert captured.out == ""  # Summary goes to stderr, stdout stays clean for --json.
+    assert "2 files, 2 probed" in captured.err
+    filter(files=[sample_image, small], criterion="w * h > 1000 and format == 'PNG'", index=index)
+    assert capsys.readouterr().out.split() == [sample_image]
+
+
+def test_filter_index_criterion_error(sample_image, tmp_path, capsys):
+    index = str(tmp_path / "im.sqlite")
+    filter(files=[sample_image], criterion="orientation > 1", index=index)  # No exif, orientation is None.
+    captured = capsys.readouterr()
+    assert captured.out == ""
+    assert "%s: TypeError" % sample_image in captured.err
+
+
+def test_info_index_missing_file(sample_image, tmp_path, capsys):
+    missing = str(tmp_path / "missing.png")
+    info(files=[sample_image, missing], index=str(tmp_path / "im.sqlite"))
+    captured = capsys.readouterr()
+    assert "Mode: RGB" in captured.out
+    assert "Cannot read image: FileNotFoundError" in captured.out
+
+
+def test_info_index_refresh(sample_image, tmp_path, capsys):
+    index = str(tmp_path / "im.sqlite")
+    build_index(files=[sample_image], index=index)
+    Image.fromarray(np.zeros((20, 30), dtype=np.uint8)).save(sample_image)  # Changed size -> re-probed.
+    info(files=[sample_image], index=index)
+    captured = capsys.readouterr()
+    assert "(30, 20)" in captured.out
+    assert "Mode: L" in captured.out
+
+
+def test_convert_failure(tmp_path, capsys):
+    src = str(tmp_path / "broken.png")
+    with open(src, "w") as f:
+        f.write("not an image")
+    failures = convert(files=[src], extension=".jpg", overwrite=False)
+    assert list(failures) == [src]
+    assert "1 of 1 files failed" in capsys.readouterr().err
+
+
+def test_convert_transparent_animated_to_jpg(tmp_path):
+    frames = [Image.fromarray(np.full((10, 10), v, dtype=np.uint8)).convert("P") for v in (0, 255)]
+    src = str(tmp_path / "t.gif")
+    frames[0].save(src, save_all=True, append_images=frames[1:], transparency=0)
+    assert convert(files=[src], extension=".jpg", overwrite=False) == {}
+    assert Image.open(str(tmp_path / "t.jpg")).mode == "RGB"
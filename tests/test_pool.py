@@ -0,0 +1,86 @@
+import multiprocessing as mp
+import os
+import time
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from im.pool import imap_pool, run_pool
+from im.utils import _DeferredIO, imread, imwrite, remove_file
+
+
+def _task(src):
+    if src == "slow":
+        time.sleep(10)
+    elif src == "crash":
+        os._exit(1)
+    elif src == "error":
+        raise ValueError("bad file")
+    return src.upper(), os.getpid()
+
+
+def test_imap_pool_results():
+    results = {src: result for src, result, error in imap_pool(_task, ["a", "b", "c"])}
+    assert {src: result[0] for src, result in results.items()} == {"a": "A", "b": "B", "c": "C"}
+
+
+def test_imap_pool_recycles_workers():
+    pids = {result[1] for _, result, _ in imap_pool(_task, ["a"] * 6, max_tasks=1)}
+    assert len(pids) == 6
+
+
+def test_run_pool_failures(capsys):
+    start = time.monotonic()
+    failures = run_pool(_task, ["a", "slow", "crash", "error"], timeout=0.5, retries=1)
+    assert time.monotonic() - start < 5
+    assert set(failures) == {"slow", "crash", "error"}
+    assert failures["slow"].startswith("timeout")
+    assert failures["crash"].startswith("worker died")
+    assert failures["error"] == "ValueError: bad file"
+    assert "3 of 4 files failed" in capsys.readouterr().err
+
+
+def _flip_and_remove(src):
+    image, _ = imread(src)
+    out = src.replace(".png", "_out.png")
+    n_bytes = imwrite(ImageOps.flip(image), out)
+    remove_file(src)  # Applied only after the output above is written.
+    return out, n_bytes
+
+
+def test_imap_pool_prefetch(tmp_path):
+    files = []
+    for i in range(5):
+        path = str(tmp_path / ("%d.png" % i))
+        Image.fromarray(np.full((4, 6), i, dtype=np.uint8)).save(path)
+        files.append(path)
+    results = {src: (result, error) for src, result, error in
+               imap_pool(_flip_and_remove, files + [str(tmp_path / "missing.png")], prefetch=True, io_depth=2)}
+    assert results[str(tmp_path / "missing.png")][1].startswith("FileNotFoundError")
+    for i, src in enumerate(files):
+        (out, n_bytes), error = results[src]
+        assert error is None
+        assert not os.path.exists(src)
+        assert os.path.getsize(out) == n_bytes
+        assert np.asarray(Image.open(out)).max() == i
+    assert sorted(os.listdir(tmp_path)) == sorted("%d_out.png" % i for i in range(5))  # No temp files left.
+
+
+def _is_prefetched(src):
+    return {"prefetched": src in _DeferredIO.inputs}
+
+
+def test_imap_pool_prefetch_more_workers_than_depth(tmp_path, monkeypatch):
+    monkeypatch.setattr(mp, "cpu_count", lambda: 8)
+    files = []
+    for i in range(16):
+        path = str(tmp_path / ("%d.bin" % i))
+        with open(path, "wb") as f:
+            f.write(b"x")
+        files.append(path)
+    for src, result, error in imap_pool(_is_prefetched, files, prefetch=True, io_depth=2):
+        assert error is None
+        assert result["prefetched"]
+        assert result["bytes_in"] == 1
+        files.remove(src)
+    assert files == []
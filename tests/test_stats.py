@@ -0,0 +1,41 @@
+import json
+
+import numpy as np
+from PIL import Image
+
+from im.im import stats
+from im.stats import Stats
+
+
+def _random_image(shape):
+    return Image.fromarray(np.random.randint(0, 255, shape, dtype=np.uint8))
+
+
+def test_merge_matches_numpy():
+    images = [_random_image((30, 40, 3)), _random_image((10, 70, 3)), _random_image((25, 25, 3))]
+    total = Stats()
+    for image in images:
+        total.merge(Stats.from_image(image, image.size, "PNG", "RGB"))
+    pixels = np.concatenate([np.asarray(image).reshape(-1, 3) for image in images])
+    result = total.to_dict()
+    np.testing.assert_allclose(list(result["mean"].values()), pixels.mean(axis=0), atol=1e-3)
+    np.testing.assert_allclose(list(result["std"].values()), pixels.std(axis=0), atol=1e-3)
+    assert result["width"] == {"min": 25, "max": 70, "mean": 45}
+    assert sum(result["aspect"]["counts"]) == 3
+
+
+def test_stats_command(tmp_path):
+    files = []
+    for name, shape in (("a.png", (20, 40, 3)), ("b.jpg", (30, 30)), ("c.png", (10, 10, 4))):
+        path = str(tmp_path / name)
+        _random_image(shape).save(path)
+        files.append(path)
+    out = str(tmp_path / "stats.json")
+    stats(files=files, max_size=0, output=out)
+    with open(out) as f:
+        result = json.load(f)
+    assert result["images"] == 3
+    assert result["pixels"] == 20 * 40 + 30 * 30 + 10 * 10
+    assert result["formats"] == {"PNG": 2, "JPEG": 1}
+    assert result["modes"] == {"RGB": 1, "L": 1, "RGBA": 1}
+    assert sum(result["histogram"]["G"]) == result["pixels"]